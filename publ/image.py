@@ -5,12 +5,13 @@ import os
 import hashlib
 import logging
 import html
+import math
 import re
 import ast
+import collections
 import concurrent.futures
 import threading
 import tempfile
-import shutil
 import time
 import random
 import io
@@ -29,7 +30,24 @@ from . import model, utils
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 # Bump this if any defaults or processing changes
-RENDITION_VERSION = 1
+RENDITION_VERSION = 2
+
+# When the source is more than this many times the size of the rendition, it
+# gets box-filtered down to within this factor before the Lanczos pass
+RESIZE_REDUCING_GAP = 3
+
+# How long (in seconds) a known rendition can be served before its existence
+# is checked (and its access time refreshed) again
+RENDITION_TOUCH_INTERVAL = 60
+
+# How many known renditions to remember
+RENDITION_CACHE_SIZE = 4096
+
+# The rendition arguments which determine a rendition's path and size
+RENDITION_ARGS = ('scale', 'scale_min_width', 'scale_min_height', 'crop',
+                  'width', 'height', 'max_width', 'max_height',
+                  'resize', 'fill_crop_x', 'fill_crop_y',
+                  'format', 'background', 'quality')
 
 
 class Image(ABC):
@@ -199,6 +217,20 @@ class LocalImage(Image):
 
     _thread_pool = None
 
+    # Renditions which are known to exist, in least-recently-used order; maps
+    # the rendition cache key to a tuple of (relative_path, size, last_checked)
+    _rendition_cache = collections.OrderedDict()
+    _rendition_cache_lock = threading.Lock()
+
+    # Renditions which are currently being generated; maps both the content
+    # path and every rendition path waiting on it to the render's Future
+    _pending = {}
+
+    # The rendition paths to place once their content path is rendered
+    _pending_names = {}
+
+    _pending_lock = threading.Lock()
+
     @staticmethod
     def thread_pool():
         """ Get the rendition threadpool """
@@ -208,6 +240,57 @@ class LocalImage(Image):
                 thread_name_prefix="Renderer")
         return LocalImage._thread_pool
 
+    @staticmethod
+    def _submit_render(path, content_path, *args):
+        """ Schedule a rendition to be generated, unless it already is. If its
+        content is already being rendered for another name, this one gets
+        placed by the same render. """
+        path = os.path.normpath(path)
+        content_path = os.path.normpath(content_path)
+        with LocalImage._pending_lock:
+            future = LocalImage._pending.get(path)
+            if future:
+                return future
+
+            future = LocalImage._pending.get(content_path)
+            if future:
+                LocalImage._pending_names[content_path].append(path)
+            else:
+                LocalImage._pending_names[content_path] = [path]
+                future = LocalImage.thread_pool().submit(*args)
+                LocalImage._pending[content_path] = future
+            LocalImage._pending[path] = future
+
+        return future
+
+    @staticmethod
+    def _next_pending_name(content_path, done=None):
+        """ Mark a rendition path as placed, and get the next one waiting on
+        the content path (or None if the render is finished) """
+        with LocalImage._pending_lock:
+            names = LocalImage._pending_names[content_path]
+            if done:
+                names.remove(done)
+                del LocalImage._pending[done]
+            if names:
+                return names[0]
+
+            del LocalImage._pending_names[content_path]
+            del LocalImage._pending[content_path]
+            return None
+
+    @staticmethod
+    def wait_render(path, timeout=None):
+        """ Wait for a pending rendition to be generated, if there is one
+
+        path -- the full path to the rendition file
+        timeout -- how long to wait, in seconds
+        """
+        with LocalImage._pending_lock:
+            future = LocalImage._pending.get(os.path.normpath(path))
+        if future:
+            concurrent.futures.wait([future], timeout=timeout)
+
     def __init__(self, record, search_path):
         """ Get the base image from an index record """
         super().__init__(search_path)
@@ -219,7 +302,7 @@ class LocalImage(Image):
         return LocalImage, self._record
 
     def get_rendition(self, output_scale=1, **kwargs):
-        # pylint:disable=too-many-locals
+        # pylint:disable=too-many-locals,too-many-branches
         """
         Get the rendition for this image, generating it if necessary.
         Returns a tuple of `(relative_path, width, height)`, where relative_path
@@ -247,15 +330,19 @@ class LocalImage(Image):
         quantize -- how large a palette to use for GIF or PNG images
         """
 
-        basename, ext = os.path.splitext(
-            os.path.basename(self._record.file_path))
-        basename = utils.make_slug(basename)
+        cache_key = self._get_cache_key(output_scale, kwargs)
+        cached = cache_key and LocalImage._get_cached_rendition(cache_key)
+        if cached and cached[2] + RENDITION_TOUCH_INTERVAL > time.time():
+            out_rel_path, size, _ = cached
+            return utils.static_url(out_rel_path, kwargs.get('absolute')), size
+
+        out_prefix, ext, out_rel_dir = self._out_path_parts
 
         if kwargs.get('format'):
             ext = '.' + kwargs['format']
 
         # The spec for building the output filename
-        out_spec = [basename, self._record.checksum[-10:]]
+        out_spec = [out_prefix]
 
         out_args = {}
         if ext in ['.png', '.jpg', '.jpeg']:
@@ -288,31 +375,119 @@ class LocalImage(Image):
             out_args['quality'] = kwargs['quality']
         if ext in ('.jpg', '.jpeg'):
             out_args['optimize'] = True
+            out_args['progressive'] = True
 
         # Build the output filename
         out_basename = '_'.join([str(s) for s in out_spec]) + ext
-        out_rel_path = os.path.join(
-            config.image_output_subdir,
-            self._record.checksum[0:2],
-            self._record.checksum[2:6],
-            out_basename)
+        out_rel_path = os.path.join(out_rel_dir, out_basename)
         out_fullpath = os.path.join(config.static_folder, out_rel_path)
 
-        if os.path.isfile(out_fullpath):
-            os.utime(out_fullpath)
+        # The encoded file is stored under a name which only depends on the
+        # image content and the rendition spec, so that sources which share a
+        # checksum (or extensions which share a format) share the encode
+        content_basename = '_'.join(
+            [self._record.checksum[-10:]] + [str(s) for s in out_spec[1:]]
+        ) + ('.jpg' if ext == '.jpeg' else ext)
+        content_fullpath = os.path.join(config.static_folder, out_rel_dir,
+                                        content_basename)
+
+        try:
+            # Refreshing the access time doubles as the existence check
+            try:
+                os.utime(out_fullpath)
+            except FileNotFoundError:
+                # The rendition might already exist under its content name
+                os.link(content_fullpath, out_fullpath)
+                os.utime(out_fullpath)
+            if cache_key:
+                LocalImage._cache_rendition(cache_key, out_rel_path, size)
             return utils.static_url(out_rel_path, kwargs.get('absolute')), size
+        except OSError:
+            # Either it hasn't been rendered, or the filesystem doesn't support
+            # hard links; either way the render thread sorts it out
+            pass
 
-        LocalImage.thread_pool().submit(
-            self._render, out_fullpath, size, box, flatten, kwargs, out_args)
+        LocalImage._submit_render(
+            out_fullpath, content_fullpath,
+            self._render, content_fullpath, size, box, flatten, kwargs, out_args)
 
         return flask.url_for('async', filename=out_rel_path, _external=kwargs.get('absolute')), size
 
     @cached_property
-    def _image(self):
-        with self._lock:
-            image = PIL.Image.open(self._record.file_path)
+    def _out_path_parts(self):
+        """ The parts of the rendition paths which don't depend on the spec:
+        a tuple of (filename prefix, default extension, relative directory) """
+        basename, ext = os.path.splitext(
+            os.path.basename(self._record.file_path))
+        checksum = self._record.checksum
+        return ('{}_{}'.format(utils.make_slug(basename), checksum[-10:]),
+                ext,
+                os.path.join(config.image_output_subdir,
+                             checksum[0:2], checksum[2:6]))
+
+    def _get_cache_key(self, output_scale, kwargs):
+        """ Get the rendition cache key for a rendition spec, or None if the
+        spec can't be used as a key. Only the arguments which go into the
+        rendition's path and size are part of the key, so that e.g. a
+        different link target still shares the entry. """
+        try:
+            args = ((k, kwargs[k]) for k in RENDITION_ARGS if k in kwargs)
+            key = (self._record.file_path, self._record.checksum, output_scale,
+                   tuple((k, tuple(v) if isinstance(v, list) else v)
+                         for k, v in args))
+            hash(key)
+            return key
+        except TypeError:
+            return None
 
-        return image
+    @staticmethod
+    def _get_cached_rendition(key):
+        """ Get a known rendition's (relative_path, size, last_checked) """
+        with LocalImage._rendition_cache_lock:
+            cached = LocalImage._rendition_cache.get(key)
+            if cached:
+                LocalImage._rendition_cache.move_to_end(key)
+            return cached
+
+    @staticmethod
+    def _cache_rendition(key, out_rel_path, size):
+        """ Remember that a rendition exists, as of now """
+        with LocalImage._rendition_cache_lock:
+            LocalImage._rendition_cache[key] = (out_rel_path, size, time.time())
+            LocalImage._rendition_cache.move_to_end(key)
+            while len(LocalImage._rendition_cache) > RENDITION_CACHE_SIZE:
+                LocalImage._rendition_cache.popitem(last=False)
+
+    def _get_source(self, size, box):
+        """ Get the source image to render from, along with the resize box
+        mapped onto it.
+
+        When a JPEG is being reduced by a large factor, this decodes it at a
+        reduced resolution (which libjpeg does natively) that is still at
+        least twice the output size, rather than decoding it in full.
+        Otherwise, the full decode is shared between renditions (e.g. the 1x
+        and 2x variants of a srcset) via the source image cache. """
+
+        _, ext = os.path.splitext(self._record.file_path)
+        if size and ext.lower() in ('.jpg', '.jpeg'):
+            if box:
+                region_w, region_h = box[2] - box[0], box[3] - box[1]
+            else:
+                region_w, region_h = self._record.width, self._record.height
+
+            # The DCT reduction is the same on both axes, so this doesn't need
+            # to care about the EXIF orientation
+            reduction = min(region_w / size[0], region_h / size[1]) / 2
+            if reduction >= 2:
+                image = _load_image(self._record.file_path, reduction)
+                if box:
+                    scale_x = image.width / self._record.width
+                    scale_y = image.height / self._record.height
+                    box = (box[0] * scale_x, box[1] * scale_y,
+                           box[2] * scale_x, box[3] * scale_y)
+                return image, box
+
+        return SOURCE_CACHE.get(self._record.file_path, self._record.fingerprint), box
 
     @staticmethod
     def _adjust_crop_box(box, crop):
@@ -343,54 +518,92 @@ class LocalImage(Image):
         x, y, w, h = crop
         return (x, y, x + w, y + h)
 
-    def _render(self, path, size, box, flatten, kwargs, out_args):
+    def _render(self, content_path, size, box, flatten, kwargs, out_args):
         # pylint:disable=too-many-arguments
-        image = self._image
-
+        content_path = os.path.normpath(content_path)
         with self._lock:
-            if os.path.isfile(path):
-                # file already exists
-                return
-
-            logger.info("Rendering file %s", path)
-
-            try:
-                os.makedirs(os.path.dirname(path))
-            except FileExistsError:
-                pass
-
-            _, ext = os.path.splitext(path)
-
-            try:
-                image = _fix_orientation(image)
-            except:
-                logger.exception('wtf')
+            path = LocalImage._next_pending_name(content_path)
+            while path:
+                try:
+                    self._place_rendition(path, content_path,
+                                          size, box, flatten, kwargs, out_args)
+                except Exception:  # pylint: disable=broad-except
+                    # Keep going, so that every name waiting on this content
+                    # leaves the pending set and can be retried later
+                    logger.exception("Failed to place rendition %s", path)
+                finally:
+                    path = LocalImage._next_pending_name(content_path, path)
+
+    def _place_rendition(self, path, content_path, *args):
+        """ Make a rendition available under its filename, rendering its
+        content file first if necessary """
+        if os.path.isfile(path):
+            # file already exists
+            return
+
+        if not os.path.isfile(content_path) and not self._encode(content_path, *args):
+            return
 
+        try:
+            os.link(content_path, path)
+            logger.info("%s: linked to %s", path, content_path)
+        except FileExistsError:
+            pass
+        except FileNotFoundError:
+            # The content file expired out from under us
+            self._encode(path, *args)
+        except OSError:
+            # The filesystem doesn't do hard links, so this name gets the
+            # encode itself rather than a copy of it
             try:
-                paletted = image.mode == 'P'
-                if paletted:
-                    image = image.convert('RGBA')
-
-                if size:
-                    image = image.resize(size=size, box=box,
-                                         resample=PIL.Image.LANCZOS)
-
-                if flatten:
-                    image = self.flatten(image, kwargs.get('background'))
-                    image = image.convert('RGB')
+                os.replace(content_path, path)
+            except FileNotFoundError:
+                self._encode(path, *args)
 
-                if ext == '.gif' or (ext == '.png' and (paletted or kwargs.get('quantize'))):
-                    image = image.quantize(kwargs.get('quantize', 256))
+    def _encode(self, path, size, box, flatten, kwargs, out_args):
+        """ Render and save an image file; returns whether it succeeded """
+        # pylint:disable=too-many-arguments
+        logger.info("Rendering file %s", path)
 
-                with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as file:
-                    temp_path = file.name
-                    image.save(file, **out_args)
-                shutil.move(temp_path, path)
+        _, ext = os.path.splitext(path)
 
-                logger.info("%s: complete", path)
-            except Exception:  # pylint: disable=broad-except
-                logger.exception("Failed to render %s -> %s",
-                                 self._record.file_path, path)
+        temp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            image, box = self._get_source(size, box)
+
+            paletted = image.mode == 'P'
+            if paletted:
+                image = image.convert('RGBA')
+
+            if size:
+                image = _resize(image, size, box)
+
+            if flatten:
+                image = self.flatten(image, kwargs.get('background'))
+
+            if ext == '.gif' or (ext == '.png' and (paletted or kwargs.get('quantize'))):
+                image = image.quantize(kwargs.get('quantize', 256))
+
+            # Write to a temporary file alongside the destination, so that
+            # the final rename is atomic and never crosses filesystems
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                                             suffix=ext,
+                                             buffering=1 << 20,
+                                             delete=False) as file:
+                temp_path = file.name
+                image.save(file, **out_args)
+            os.replace(temp_path, path)
+
+            logger.info("%s: complete", path)
+            return True
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Failed to render %s -> %s",
+                             self._record.file_path, path)
+            if temp_path and os.path.isfile(temp_path):
+                os.unlink(temp_path)
+            return False
 
     def get_rendition_size(self, spec, output_scale, crop):
         """
@@ -419,6 +632,15 @@ class LocalImage(Image):
 
         raise ValueError("Unknown resize mode {}".format(mode))
 
+    @staticmethod
+    def _get_size_limits(spec):
+        """ Get the effective (width, height) limits of a spec; each one is the
+        tighter of the target and maximum sizes, or None if neither is set """
+        return (min(filter(None, (spec.get('width'), spec.get('max_width'))),
+                    default=None),
+                min(filter(None, (spec.get('height'), spec.get('max_height'))),
+                    default=None))
+
     @staticmethod
     def get_rendition_fit_size(spec, input_w, input_h, output_scale):
         """ Determine the scaled size based on the provided spec """
@@ -441,17 +663,9 @@ class LocalImage(Image):
             width = width * min_height / height
             height = min_height
 
-        tgt_width, tgt_height = spec.get('width'), spec.get('height')
-
-        if tgt_width and width > tgt_width:
-            height = height * tgt_width / width
-            width = tgt_width
-
-        if tgt_height and height > tgt_height:
-            width = width * tgt_height / height
-            height = tgt_height
-
-        tgt_width, tgt_height = spec.get('max_width'), spec.get('max_height')
+        # Every limit preserves the aspect ratio, so only the tightest limit on
+        # each axis can matter
+        tgt_width, tgt_height = LocalImage._get_size_limits(spec)
 
         if tgt_width and width > tgt_width:
             height = height * tgt_width / width
@@ -482,21 +696,21 @@ class LocalImage(Image):
             width = width / scale
             height = height / scale
 
-        if spec.get('scale_min_width'):
-            width = max(width, spec['spec_min_width'])
+        min_width = spec.get('scale_min_width')
+        if min_width and width < min_width:
+            width = min_width
+
+        min_height = spec.get('scale_min_height')
+        if min_height and height < min_height:
+            height = min_height
 
-        if spec.get('scale_min_height'):
-            height = max(height, spec['scale_min_height'])
+        tgt_width, tgt_height = LocalImage._get_size_limits(spec)
 
-        if spec.get('width'):
-            width = min(width, spec['width'])
-        if spec.get('max_width'):
-            width = min(width, spec['max_width'])
+        if tgt_width and width > tgt_width:
+            width = tgt_width
 
-        if spec.get('height'):
-            height = min(height, spec['height'])
-        if spec.get('max_height'):
-            height = min(height, spec['max_height'])
+        if tgt_height and height > tgt_height:
+            height = tgt_height
 
         width = width * output_scale
         height = height * output_scale
@@ -541,21 +755,11 @@ class LocalImage(Image):
         if min_height and height < min_height:
             height = min_height
 
-        tgt_width, tgt_height = spec.get('width'), spec.get('height')
-
-        if tgt_width and width > tgt_width:
-            width = tgt_width
-
-        tgt_height = spec.get('height')
-        if tgt_height and height > tgt_height:
-            height = tgt_height
-
-        tgt_width, tgt_height = spec.get('max_width'), spec.get('max_height')
+        tgt_width, tgt_height = LocalImage._get_size_limits(spec)
 
         if tgt_width and width > tgt_width:
             width = tgt_width
 
-        tgt_height = spec.get('height')
         if tgt_height and height > tgt_height:
             height = tgt_height
 
@@ -569,7 +773,9 @@ class LocalImage(Image):
         """ Flatten an image, with an optional background color """
         if bgcolor:
             background = PIL.Image.new('RGB', image.size, bgcolor)
-            background.paste(image, mask=image.split()[3])
+            # An RGBA mask uses its alpha channel, so this doesn't have to be
+            # split out into its own image
+            background.paste(image, mask=image)
             return background
 
         return image.convert('RGB')
@@ -640,6 +846,10 @@ class LocalImage(Image):
                     except OSError:
                         logger.exception("Couldn't remove %s", path)
 
+        # forget about any renditions that might have just been removed
+        with LocalImage._rendition_cache_lock:
+            LocalImage._rendition_cache.clear()
+
 
 class ExternalImage(Image):
     """ Base class for images which are rendered by external means """
@@ -777,6 +987,94 @@ class ImageNotFound(Image):
         return '/* not found: {} */'.format(self.path)
 
 
+class SourceCache:
+    """ LRU cache of decoded source images, bounded by the total size of their
+    pixel data (config.image_source_cache_size) """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._images = collections.OrderedDict()
+        self._size = 0
+
+    @staticmethod
+    def _image_size(image):
+        return image.width * image.height * len(image.getbands())
+
+    def get(self, file_path, fingerprint):
+        """ Get the decoded, correctly-oriented image for a file
+
+        file_path -- the path to the image file
+        fingerprint -- the file's current fingerprint
+        """
+        key = (file_path, fingerprint)
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                return image
+
+        image = _load_image(file_path)
+        size = self._image_size(image)
+        limit = config.image_source_cache_size or 0
+
+        with self._lock:
+            if key not in self._images and size <= limit:
+                self._images[key] = image
+                self._size += size
+                while self._size > limit:
+                    _, evicted = self._images.popitem(last=False)
+                    self._size -= self._image_size(evicted)
+
+        return image
+
+
+SOURCE_CACHE = SourceCache()
+
+
+def _load_image(file_path, reduction=None):
+    """ Load and correctly orient an image file.
+
+    reduction -- if set, allow the image to be decoded at a resolution reduced
+        by up to this factor, if the format supports it (i.e. JPEG)
+    """
+
+    image = PIL.Image.open(file_path)
+    if reduction:
+        image.draft(image.mode, (math.ceil(image.width / reduction),
+                                 math.ceil(image.height / reduction)))
+    image.load()
+
+    try:
+        image = _fix_orientation(image)
+    except:  # pylint:disable=bare-except
+        logger.exception("Error fixing orientation of %s", file_path)
+
+    return image
+
+
+def _resize(image, size, box):
+    """ Resize (a region of) an image with Lanczos resampling.
+
+    The Lanczos kernel's support grows with the reduction factor, so large
+    reductions first get an integer-factor box filter pass (as with Pillow's
+    reducing_gap), which is far cheaper and not visibly different at that gap.
+    """
+
+    if box:
+        region_w, region_h = box[2] - box[0], box[3] - box[1]
+    else:
+        region_w, region_h = image.size
+
+    factor = int(min(region_w / size[0], region_h / size[1]) / RESIZE_REDUCING_GAP)
+    if factor > 1:
+        image = image.resize((math.ceil(region_w / factor), math.ceil(region_h / factor)),
+                             box=box, resample=PIL.Image.BOX)
+        box = None
+
+    return image.resize(size=size, box=box, resample=PIL.Image.LANCZOS)
+
+
 def _fix_orientation(image):
     """ adapted from https://stackoverflow.com/a/30462851/318857
 
@@ -788,7 +1086,6 @@ def _fix_orientation(image):
         1 through 8. Other values are reserved.
     """
 
-    exif_orientation_tag = 0x0112
     exif_transpose_sequences = [
         [],
         [],
@@ -801,14 +1098,107 @@ def _fix_orientation(image):
         [PIL.Image.ROTATE_90],
     ]
 
-    try:
-        orientation = image._getexif()[exif_orientation_tag]
+    orientation = _get_orientation(image)
+    if orientation:
         sequence = exif_transpose_sequences[orientation]
         return functools.reduce(type(image).transpose, sequence, image)
+    return image
+
+
+def _get_orientation(image):
+    """ Get the EXIF orientation of an image, or None if it doesn't have one.
+
+    This only needs the image header, not the pixel data. """
+
+    exif_orientation_tag = 0x0112
+
+    try:
+        return image._getexif()[exif_orientation_tag]
     except (TypeError, AttributeError, KeyError):
         # either no EXIF tags or no orientation tag
-        pass
-    return image
+        return None
+
+
+def _file_checksum(file_path):
+    """ Compute the content checksum of a file """
+    if hasattr(hashlib, 'blake2b'):
+        return _file_digest(file_path, functools.partial(
+            hashlib.blake2b, bytes(RENDITION_VERSION), digest_size=16))
+
+    # Python 3.5
+    return _file_digest(file_path, functools.partial(
+        hashlib.md5, bytes(RENDITION_VERSION)))
+
+
+def _asset_checksum(file_path):
+    """ Compute the checksum that an asset's URL is based on. This is the
+    original checksum scheme, kept so that published asset links don't move
+    when the content checksum changes. """
+    return _file_digest(file_path, functools.partial(hashlib.md5, bytes(1)))
+
+
+def _file_digest(file_path, new_digest):
+    """ Compute the hexdigest of a file with a hashlib constructor """
+    with open(file_path, 'rb') as file:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(file, new_digest).hexdigest()
+
+        # Python < 3.11 doesn't have file_digest, so read it in ourselves
+        digest = new_digest()
+        buf = bytearray(1 << 20)
+        view = memoryview(buf)
+        size = file.readinto(buf)
+        while size:
+            digest.update(view[:size])
+            size = file.readinto(buf)
+
+    return digest.hexdigest()
+
+
+def _scan_asset(file_path, fingerprint):
+    """ Compute the index values for an asset file, without touching the
+    database """
+
+    values = {
+        'file_path': file_path,
+        'checksum': _file_checksum(file_path),
+        'fingerprint': fingerprint,
+    }
+
+    try:
+        # This only reads the header; there's no need to decode the pixels
+        image = PIL.Image.open(file_path)
+    except IOError:
+        image = None
+
+    if image:
+        width, height = image.size
+        if _get_orientation(image) in (5, 6, 7, 8):
+            # The image gets rotated by 90 degrees for display
+            width, height = height, width
+        values['width'] = width
+        values['height'] = height
+        values['transparent'] = image.mode in ('RGBA', 'P')
+        values['is_asset'] = False
+        image.close()
+    else:
+        # PIL could not figure out what file type this is, so treat it as
+        # an asset
+        values['is_asset'] = True
+        values['asset_name'] = os.path.join(_asset_checksum(file_path)[:5],
+                                            os.path.basename(file_path))
+
+    return values
+
+
+def _store_asset(record, values):
+    """ Store the index values for an asset file; must be called within a
+    db_session """
+    if record:
+        record.set(**values)
+    else:
+        record = model.Image(**values)
+    return record
 
 
 @orm.db_session(immediate=True)
@@ -819,47 +1209,52 @@ def _get_asset(file_path):
     if not record or record.fingerprint != fingerprint:
         # Reindex the file
         logger.info("Updating image %s -> %s", file_path, fingerprint)
-
-        # compute the md5sum; from https://stackoverflow.com/a/3431838/318857
-        md5 = hashlib.md5()
-        md5.update(bytes(RENDITION_VERSION))
-        with open(file_path, 'rb') as file:
-            for chunk in iter(lambda: file.read(16384), b""):
-                md5.update(chunk)
-
-        values = {
-            'file_path': file_path,
-            'checksum': md5.hexdigest(),
-            'fingerprint': fingerprint,
-        }
-
-        try:
-            image = PIL.Image.open(file_path)
-            image = _fix_orientation(image)
-        except IOError:
-            image = None
-
-        if image:
-            values['width'] = image.width
-            values['height'] = image.height
-            values['transparent'] = image.mode in ('RGBA', 'P')
-            values['is_asset'] = False
-        else:
-            # PIL could not figure out what file type this is, so treat it as
-            # an asset
-            values['is_asset'] = True
-            values['asset_name'] = os.path.join(values['checksum'][:5],
-                                                os.path.basename(file_path))
-        record = model.Image.get(file_path=file_path)
-        if record:
-            record.set(**values)
-        else:
-            record = model.Image(**values)
+        record = _store_asset(record, _scan_asset(file_path, fingerprint))
         orm.commit()
 
     return record
 
 
+def is_image_file(file_path):
+    """ Determine whether a file is (probably) an image, based on its extension """
+    _, ext = os.path.splitext(file_path)
+    return ext.lower() in PIL.Image.registered_extensions()
+
+
+def scan_files(fingerprints):
+    """ Bring the index up to date for a batch of image files, so that they
+    don't need to be indexed on first use.
+
+    fingerprints -- a dict mapping each file path to its current fingerprint
+    """
+
+    with orm.db_session:
+        stale = {path: fingerprint for path, fingerprint in fingerprints.items()
+                 if not model.Image.exists(file_path=path, fingerprint=fingerprint)}
+    if not stale:
+        return
+
+    # Hashing releases the GIL, so the files can be checksummed in parallel
+    # threads; the database writes all happen in this one
+    scanned = []
+    with concurrent.futures.ThreadPoolExecutor(thread_name_prefix="ImageScanner") as pool:
+        futures = {pool.submit(_scan_asset, path, fingerprint): path
+                   for path, fingerprint in stale.items()}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                scanned.append(future.result())
+            except Exception:  # pylint: disable=broad-except
+                # A bad file shouldn't keep the rest of the batch from being
+                # indexed; it'll get another try when it's first used
+                logger.exception("Could not scan image %s", futures[future])
+
+    with orm.db_session(immediate=True):
+        for values in scanned:
+            logger.info("Updating image %s -> %s",
+                        values['file_path'], values['fingerprint'])
+            _store_asset(model.Image.get(file_path=values['file_path']), values)
+
+
 def get_image(path, search_path):
     """ Get an Image object. If the path is given as absolute, it will be
     relative to the content directory; otherwise it will be relative to the
@@ -977,7 +1372,12 @@ def clean_cache(max_age):
 def get_async(filename):
     """ Asynchronously fetch an image """
 
-    if os.path.isfile(os.path.join(config.static_folder, filename)):
+    fullpath = os.path.join(config.static_folder, filename)
+
+    # Give an in-progress render a chance to finish
+    LocalImage.wait_render(fullpath, timeout=1)
+
+    if os.path.isfile(fullpath):
         return flask.redirect(flask.url_for('static', filename=filename))
 
     retry_count = int(flask.request.args.get('retry_count', 0))
@@ -11,6 +11,7 @@ import watchdog.events
 from pony import orm
 
 from . import entry
+from . import image
 from . import model
 from . import utils
 from . import category
@@ -206,24 +207,50 @@ def prune_missing(table):
         logger.exception("Error pruning %s", table)
 
 
+def walk_directory(root):
+    """ Walk a directory tree, following symlinks; yields a tuple of
+    (directory, file_entries) for each directory, where file_entries is a list
+    of os.scandir() entries (whose stat information is cached) """
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        logger.warning("Could not scan directory %s", root)
+        return
+
+    yield root, [item for item in entries if item.is_file()]
+
+    for item in entries:
+        if item.is_dir():
+            yield from walk_directory(item.path)
+
+
 def scan_index(content_dir):
     """ Scan all files in a content directory """
 
     def scan_directory(root, files):
         """ Helper function to scan a single directory """
         try:
+            images = {}
             for file in files:
-                fullpath = os.path.join(root, file)
+                fullpath = file.path
                 relpath = os.path.relpath(fullpath, content_dir)
 
-                fingerprint = utils.file_fingerprint(fullpath)
+                fingerprint = utils.dir_entry_fingerprint(file)
+                if image.is_image_file(fullpath):
+                    # keyed the same way get_image will look it up
+                    images[os.path.normpath(fullpath)] = fingerprint
+                    continue
+
                 last_fingerprint = get_last_fingerprint(fullpath)
                 if fingerprint != last_fingerprint and SCHEDULED_FILES.add(fullpath):
                     scan_file(fullpath, relpath, False)
+
+            if images:
+                image.scan_files(images)
         except:  # pylint:disable=bare-except
             logger.exception("Got error parsing directory %s", root)
 
-    for root, _, files in os.walk(content_dir, followlinks=True):
+    for root, files in walk_directory(content_dir):
         THREAD_POOL.submit(scan_directory, root, files)
 
     for table in (model.Entry, model.Category, model.Image, model.FileFingerprint):
@@ -228,7 +228,20 @@ def make_tag(name, attrs, start_end=False):
 def file_fingerprint(fullpath):
     """ Get a metadata fingerprint for a file """
     stat = os.stat(fullpath)
-    return ','.join([str(value) for value in [stat.st_ino, stat.st_mtime, stat.st_size] if value])
+    return _stat_fingerprint(stat.st_ino, stat)
+
+
+def dir_entry_fingerprint(entry):
+    """ Get a metadata fingerprint for an os.scandir() entry, using its cached
+    stat information """
+    stat = entry.stat()
+
+    # DirEntry.stat() doesn't provide the inode on Windows
+    return _stat_fingerprint(stat.st_ino or entry.inode(), stat)
+
+
+def _stat_fingerprint(inode, stat):
+    return ','.join([str(value) for value in [inode, stat.st_mtime, stat.st_size] if value])
 
 
 def remap_args(input_args, remap):